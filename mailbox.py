@@ -1,32 +1,127 @@
 import datetime
 import sqlite3
+import re
 import threading
 
-from typing import Tuple, Union
+from email.parser import HeaderParser
+from email import policy
+from typing import Dict, Iterator, List, Tuple, Union
+
+import session_trace
+
+# stored in the user_version pragma once the database is fully migrated
+SCHEMA_VERSION = 1
+
+# header name -> column name
+INDEXED_HEADERS = {
+    'Message-ID': 'message_id',
+    'From': 'from_addr',
+    'Subject': 'subject',
+    'Date': 'date',
+}
+
+
+def parse_headers(msg: str) -> Dict[str, Union[str, None]]:
+    """
+    parse the indexed headers of a message.
+    missing, empty or malformed headers are returned as None.
+    """
+    # only the header block is parsed, the body may be arbitrarily large
+    header_block = re.split(r'\r?\n\r?\n', msg, 1)[0]
+    headers = HeaderParser(policy=policy.default).parsestr(header_block)
+    result = {}
+    for header, column in INDEXED_HEADERS.items():
+        try:
+            value = headers[header]
+            result[column] = str(value or '').strip() or None
+        except Exception:
+            result[column] = None
+    return result
 
 
 class MailboxDB:
-    def __init__(self, db_path='mailbox.sqlite3'):
+    def __init__(self,
+                 db_path='mailbox.sqlite3',
+                 dedup_window=datetime.timedelta(days=1)):
         self.db = sqlite3.connect(db_path, check_same_thread=False)
         self.lock = threading.Lock()
+        # messages with a Message-ID already received within this window are dropped
+        self.dedup_window = dedup_window
 
         if not self._db_query(
                 "select 1 from sqlite_master where name='message'"):
             self._db_exec(
-                "create table message(id integer primary key, content varchar, recv_date timestamp, del boolean)"
+                "create table message(id integer primary key, content varchar, recv_date timestamp, del boolean, message_id varchar, from_addr varchar, subject varchar, date varchar)"
             )
+            self._db_exec(f"pragma user_version={SCHEMA_VERSION}")
+        elif self._db_query("pragma user_version")[0][0] < SCHEMA_VERSION:
+            # databases created before headers were indexed.
+            # user_version is only set once every row is backfilled,
+            # so an interrupted migration is run again on the next start.
+            columns = [i[1] for i in self._db_query("pragma table_info(message)")]
+            for column in INDEXED_HEADERS.values():
+                if column not in columns:
+                    self._db_exec(
+                        f"alter table message add column {column} varchar")
+            self._backfill_headers()
+            self._db_exec(f"pragma user_version={SCHEMA_VERSION}")
+
+        self._db_exec(
+            "create index if not exists message_message_id on message(message_id, recv_date)"
+        )
+        # Message-IDs of deleted messages, kept for dedup_window so that
+        # late retries of already downloaded mail are still dropped
+        self._db_exec(
+            "create table if not exists deleted_message(message_id varchar, recv_date timestamp)"
+        )
+        self._db_exec(
+            "create index if not exists deleted_message_message_id on deleted_message(message_id, recv_date)"
+        )
+        # lets the row_number() window walk the table without sorting it
+        self._db_exec(
+            "create index if not exists message_recv_date on message(recv_date)"
+        )
+
+    def _backfill_headers(self, chunk_size: int = 1000):
+        """
+        parse the headers of messages stored before they were indexed.
+        """
+        last_id = -1
+        while True:
+            rows = self._db_query(
+                "select id, content from message where id>? order by id limit ?",
+                [last_id, chunk_size])
+            if not rows:
+                break
+            updates = []
+            for msg_id, content in rows:
+                headers = parse_headers(content or '')
+                updates.append([
+                    headers['message_id'], headers['from_addr'],
+                    headers['subject'], headers['date'], msg_id
+                ])
+            self.db.executemany(
+                "update message set message_id=?, from_addr=?, subject=?, date=? where id=?",
+                updates)
+            self.db.commit()
+            last_id = rows[-1][0]
 
     def _db_query(self, sql: str, args: list = []) -> tuple:
-        return self.db.execute(sql, args).fetchall()
+        with session_trace.phase('db'):
+            return self.db.execute(sql, args).fetchall()
 
     def _db_exec(self, sql: str, args: list = []):
-        self.db.execute(sql, args)
-        self.db.commit()
+        with session_trace.phase('db'):
+            self.db.execute(sql, args)
+            self.db.commit()
+
+    def get_message_count(self) -> int:
+        return self._db_query("select count(*) from message where del=0")[0][0]
 
     def get_stat(self) -> Tuple[int]:
-        raw_count = self._db_query("select count(*) from message where del=0")
-        if raw_count[0][0]:
-            return (raw_count[0][0],
+        message_num = self.get_message_count()
+        if message_num:
+            return (message_num,
                     self._db_query(
                         "select sum(length(content)) from message where del=0")
                     [0][0])
@@ -44,28 +139,42 @@ class MailboxDB:
         else:
             raise Exception("no such message")
 
-    def get_message_length_list(self) -> Tuple[Tuple[int]]:
-        return tuple(
-            map(
-                lambda i: i[:2],
-                filter(
-                    lambda i: not i[2],
-                    self._db_query(
-                        "select row_number() over (order by recv_date desc) as row_num, length(content), del from message"
-                    ))))
+    def _db_iter(self,
+                 sql: str,
+                 args: list = [],
+                 chunk_size: int = 1000) -> Iterator[List[tuple]]:
+        """
+        yield the rows of a query in lists of at most chunk_size rows,
+        so that large results are never materialized at once.
+        """
+        with session_trace.phase('db'):
+            cursor = self.db.execute(sql, args)
+        try:
+            while True:
+                with session_trace.phase('db'):
+                    rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
+    def iter_message_length_list(self,
+                                 chunk_size: int = 1000
+                                 ) -> Iterator[List[Tuple[int]]]:
+        return self._db_iter(
+            "select row_num, length from (select row_number() over (order by recv_date desc) as row_num, length(content) as length, del from message) where del=0",
+            chunk_size=chunk_size)
 
     def get_message_length_with_id(self, msg_id: int) -> int:
         return len(self.get_message_with_id(msg_id))
 
-    def get_message_uid_list(self) -> Tuple[Tuple[int]]:
-        return tuple(
-            map(
-                lambda i: i[:2],
-                filter(
-                    lambda i: not i[2],
-                    self._db_query(
-                        "select row_number() over (order by recv_date desc) as row_num, id, del from message"
-                    ))))
+    def iter_message_uid_list(self,
+                              chunk_size: int = 1000
+                              ) -> Iterator[List[Tuple[int]]]:
+        return self._db_iter(
+            "select row_num, id from (select row_number() over (order by recv_date desc) as row_num, id, del from message) where del=0",
+            chunk_size=chunk_size)
 
     def get_message_uid_with_id(self, msg_id: int) -> str:
         query_result = self._db_query(
@@ -89,15 +198,49 @@ class MailboxDB:
     def reset_messages(self):
         self._db_exec("update message set del=0 where del=1")
 
-    def insert_message(self, msg: str):
-        self._db_exec("insert into message values(null, ?, ?, 0)",
-                      [msg, datetime.datetime.now()])
+    def is_duplicate(self, message_id: Union[str, None]) -> bool:
+        if not message_id:
+            return False
+        since = datetime.datetime.now() - self.dedup_window
+        return bool(
+            self._db_query(
+                "select 1 from message where message_id=? and recv_date>=? union all select 1 from deleted_message where message_id=? and recv_date>=? limit 1",
+                [message_id, since, message_id, since]))
+
+    def insert_message(self,
+                       msg: str,
+                       headers: Union[Dict[str, Union[str, None]],
+                                      None] = None) -> bool:
+        """
+        headers are the result of parse_headers(msg),
+        pass them to parse the message before the lock is acquired.
+        return False if the message was dropped as a duplicate.
+        """
+        if headers is None:
+            headers = parse_headers(msg)
+        if self.is_duplicate(headers['message_id']):
+            return False
+
+        self._db_exec(
+            "insert into message(content, recv_date, del, message_id, from_addr, subject, date) values(?, ?, 0, ?, ?, ?, ?)",
+            [
+                msg,
+                datetime.datetime.now(), headers['message_id'],
+                headers['from_addr'], headers['subject'], headers['date']
+            ])
+        return True
 
     def _perform_deletion(self):
+        self._db_exec(
+            "insert into deleted_message select message_id, recv_date from message where del=1 and message_id is not null"
+        )
         self._db_exec("delete from message where del=1")
+        self._db_exec("delete from deleted_message where recv_date<?",
+                      [datetime.datetime.now() - self.dedup_window])
 
     def aquire(self):
-        self.lock.acquire()
+        with session_trace.phase('lock'):
+            self.lock.acquire()
 
     def release(self):
         self._perform_deletion()
@@ -1,8 +1,11 @@
 import threading
+import datetime
 import logging
 
 import configparser
 
+from mailbox import db
+import session_trace
 from pop3 import POP3Server
 from smtp import SMTPServer
 
@@ -14,6 +17,19 @@ def main():
     config = configparser.ConfigParser()
     config.read("config.ini")
 
+    db.dedup_window = datetime.timedelta(
+        seconds=config.getint('config', 'dedup_window', fallback=86400))
+
+    session_trace.slow_session_threshold = config.getfloat(
+        'config', 'slow_session_threshold', fallback=0)
+    session_trace.profile_window = config.getfloat(
+        'config', 'profile_window', fallback=30)
+    session_trace.profile_interval = config.getfloat(
+        'config', 'profile_interval', fallback=0.01)
+    session_trace.profile_dir = config.get(
+        'config', 'profile_dir', fallback='.')
+    session_trace.install_signal_handler()
+
     smtp_server = SMTPServer(config['config']['domain'],
                              config['config']['username'],
                              config['config']['password'])
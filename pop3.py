@@ -5,8 +5,9 @@ import sys
 
 from enum import Enum
 from mailbox import db
+import session_trace
 from utils import recv_response
-from typing import Tuple, Union
+from typing import Iterator, List, Tuple, Union
 
 
 class POP3State(Enum):
@@ -101,7 +102,8 @@ class POP3ServerThread(threading.Thread):
 
     def _recv_command(self) -> POP3Command:
         try:
-            data = recv_response(self._connection)
+            with session_trace.phase('network'):
+                data = recv_response(self._connection)
             logging.info(
                 f'POP3ServerThread received command from {self._peer_name}: {data}'
             )
@@ -138,13 +140,8 @@ class POP3ServerThread(threading.Thread):
 
     def _list(self, args: Tuple[str]) -> Union[bool, None]:
         if len(args) == 0:
-            message_length_list = db.get_message_length_list()
-            response = f'{len(message_length_list)} messages\r\n'
-            for i, length in message_length_list:
-                response += f'{i} {length}\r\n'
-            response += '.'
-
-            self._send_ok(response)
+            self._send_multiline(f'{db.get_message_count()} messages',
+                                 db.iter_message_length_list())
 
         elif len(args) == 1:
             try:
@@ -206,13 +203,7 @@ class POP3ServerThread(threading.Thread):
 
     def _uidl(self, args: Tuple[str]) -> Union[bool, None]:
         if len(args) == 0:
-            message_uid_list = db.get_message_uid_list()
-            response = '\r\n'
-            for i, uid in message_uid_list:
-                response += f'{i} {uid}\r\n'
-            response += '.'
-
-            self._send_ok(response)
+            self._send_multiline('', db.iter_message_uid_list())
 
         elif len(args) == 1:
             try:
@@ -230,6 +221,22 @@ class POP3ServerThread(threading.Thread):
         logging.info(
             f'POP3ServerThread sent response to {self._peer_name}: {response}')
 
+    def _send_multiline(self, message: str,
+                        chunks: Iterator[List[Tuple[int]]]):
+        """
+        send a positive multi-line response whose lines are the pairs
+        yielded by chunks, one chunk per sendall, ending with the '.' line.
+        """
+        self._send_ok(message)
+        line_num = 0
+        for chunk in chunks:
+            self._connection.sendall(''.join(
+                f'{i} {value}\r\n' for i, value in chunk).encode())
+            line_num += len(chunk)
+        self._connection.sendall(b'.\r\n')
+        logging.info(
+            f'POP3ServerThread sent {line_num} lines to {self._peer_name}')
+
     def _send_ok(self, message: str = ''):
         self._send_response(True, message)
 
@@ -245,11 +252,15 @@ class POP3ServerThread(threading.Thread):
         sys.exit()
 
     def run(self):
-        # greeting
-        self._send_ok()
-        command = self._recv_command()
-        # if the dispatcher return True, terminate the loop
-        while not self._dispatch(command):
+        session_trace.begin_session(f'POP3 {self._peer_name}')
+        try:
+            # greeting
+            self._send_ok()
             command = self._recv_command()
+            # if the dispatcher return True, terminate the loop
+            while not self._dispatch(command):
+                command = self._recv_command()
 
-        self._exit()
+            self._exit()
+        finally:
+            session_trace.end_session()
@@ -0,0 +1,168 @@
+import contextlib
+import threading
+import datetime
+import logging
+import signal
+import time
+import sys
+import os
+
+from collections import Counter
+from typing import Dict, Union
+
+PHASES = ('network', 'db', 'lock', 'remote')
+
+# sessions taking longer than this many seconds are logged with a phase breakdown.
+# 0 disables slow session tracing.
+slow_session_threshold = 0.0
+# how long a profiling run lasts, in seconds
+profile_window = 30.0
+# time between two samples, in seconds
+profile_interval = 0.01
+# where profiling results are written
+profile_dir = '.'
+
+_local = threading.local()
+_null_phase = contextlib.nullcontext()
+# thread ident -> class name of the running server threads, sampled by the profiler
+_workers: Dict[int, str] = {}
+_sampler: Union['Sampler', None] = None
+
+
+class SessionTrace:
+    def __init__(self, name: str):
+        self.name = name
+        self.start = time.perf_counter()
+        self.phases = dict.fromkeys(PHASES, 0.0)
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - start
+
+    def report(self):
+        total = time.perf_counter() - self.start
+        if total < slow_session_threshold:
+            return
+
+        breakdown = ', '.join(f'{name} {duration:.3f}s'
+                              for name, duration in self.phases.items())
+        other = total - sum(self.phases.values())
+        logging.warning(
+            f'slow session {self.name}: total {total:.3f}s, {breakdown}, other {other:.3f}s'
+        )
+
+
+def begin_session(name: str):
+    """
+    called by a server thread when its session starts.
+    """
+    _workers[threading.get_ident()] = type(threading.current_thread()).__name__
+    _local.trace = SessionTrace(name) if slow_session_threshold > 0 else None
+
+
+def end_session():
+    """
+    called by a server thread when its session ends.
+    """
+    _workers.pop(threading.get_ident(), None)
+    trace = getattr(_local, 'trace', None)
+    if trace:
+        _local.trace = None
+        trace.report()
+
+
+def phase(name: str):
+    """
+    context manager timing a phase of the current session.
+    does nothing when slow session tracing is disabled.
+    """
+    trace = getattr(_local, 'trace', None)
+    if trace:
+        return trace.phase(name)
+    return _null_phase
+
+
+class Sampler(threading.Thread):
+    """
+    periodically samples the stacks of the server threads
+    and writes the aggregated stacks to a file once the window is over.
+    """
+    def __init__(self, window: float, interval: float, output_dir: str):
+        super().__init__(daemon=True)
+        self._window = window
+        self._interval = interval
+        self._output_dir = output_dir
+        self._stacks: Counter = Counter()
+        self._sample_num = 0
+
+    def _sample(self):
+        frames = sys._current_frames()
+        for ident, thread_class in tuple(_workers.items()):
+            frame = frames.get(ident)
+            stack = []
+            while frame:
+                code = frame.f_code
+                stack.append(
+                    f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+                )
+                frame = frame.f_back
+            if stack:
+                self._stacks[(thread_class, *reversed(stack))] += 1
+        self._sample_num += 1
+
+    def _dump(self) -> str:
+        path = os.path.join(
+            self._output_dir,
+            f'profile-{datetime.datetime.now():%Y%m%d-%H%M%S}.txt')
+
+        # samples in which a function is on top of the stack
+        self_time: Counter = Counter()
+        for stack, count in self._stacks.items():
+            self_time[stack[-1]] += count
+        total = sum(self_time.values())
+
+        with open(path, 'w') as f:
+            f.write(f'# {self._sample_num} samples, '
+                    f'{self._interval * 1000:.0f}ms interval\n')
+            f.write('# top functions by self samples\n')
+            for function, count in self_time.most_common(30):
+                f.write(f'# {count:8d} {count / total:6.1%} {function}\n')
+            # folded stacks, usable with flamegraph tools
+            for stack, count in self._stacks.most_common():
+                f.write(f'{";".join(stack)} {count}\n')
+        return path
+
+    def run(self):
+        global _sampler
+        logging.info(f'profiling started for {self._window}s')
+        deadline = time.monotonic() + self._window
+        try:
+            while time.monotonic() < deadline:
+                self._sample()
+                time.sleep(self._interval)
+            logging.info(f'profiling results written to {self._dump()}')
+        except Exception as e:
+            logging.error(f'profiling failed: {e}')
+        finally:
+            _sampler = None
+
+
+def start_profiling():
+    global _sampler
+    if _sampler:
+        logging.info('profiling is already running')
+        return
+    _sampler = Sampler(profile_window, profile_interval, profile_dir)
+    _sampler.start()
+
+
+def install_signal_handler():
+    """
+    start profiling when the process receives SIGUSR1.
+    """
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: start_profiling())
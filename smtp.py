@@ -6,7 +6,8 @@ import sys
 import re
 
 from utils import get_mx, recv_response
-from mailbox import db
+from mailbox import db, parse_headers
+import session_trace
 
 
 class SMTPResponse:
@@ -160,7 +161,7 @@ class SMTPServerThread(threading.Thread):
 
         self._as_submission_server = False
         self._rcpt_to: str
-        self._mail_content: str
+        self._mail_content = ''
 
         self._connection.settimeout(10)
         # for logging purpose
@@ -173,7 +174,8 @@ class SMTPServerThread(threading.Thread):
 
     def _recv_response(self, ends_with='\r\n') -> str:
         try:
-            response = recv_response(self._connection, ends_with)
+            with session_trace.phase('network'):
+                response = recv_response(self._connection, ends_with)
             return response
         except Exception:
             self._exit()
@@ -278,16 +280,22 @@ class SMTPServerThread(threading.Thread):
         if self._mail_content:
             if self._as_submission_server:
                 try:
-                    client = SMTPSender(self._server.address, self._rcpt_to)
-                    client.connect()
-                    client.send(self._mail_content)
-                    client.close()
+                    with session_trace.phase('remote'):
+                        client = SMTPSender(self._server.address,
+                                            self._rcpt_to)
+                        client.connect()
+                        client.send(self._mail_content)
+                        client.close()
                 except Exception as e:
                     logging.error(
                         f'failed sending mail to {self._rcpt_to}: {e}')
             else:
+                headers = parse_headers(self._mail_content)
                 db.aquire()
-                db.insert_message(self._mail_content)
+                if not db.insert_message(self._mail_content, headers):
+                    logging.info(
+                        f'SMTPServerThread dropped duplicate message from {self._peer_name}'
+                    )
                 db.release()
 
         logging.info(
@@ -296,9 +304,14 @@ class SMTPServerThread(threading.Thread):
         sys.exit()
 
     def run(self):
-        self._send_response(f'220 {self._server.domain} Demo SMTP Server')
-        for func in (self._helo, self._mail_from, self._rcpt_to, self._data,
-                     self._actual_data, self._quit):
-            self._process_command(func)
+        session_trace.begin_session(f'SMTP {self._peer_name}')
+        try:
+            self._send_response(
+                f'220 {self._server.domain} Demo SMTP Server')
+            for func in (self._helo, self._mail_from, self._rcpt_to,
+                         self._data, self._actual_data, self._quit):
+                self._process_command(func)
 
-        self._exit()
+            self._exit()
+        finally:
+            session_trace.end_session()